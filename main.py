@@ -7,32 +7,88 @@ A tiny FastAPI service that monitors uptime and response time.
 from __future__ import annotations
 import asyncio
 import contextlib
+import gzip
+import hashlib
 import json
+import logging
 import math
 import os
 import sqlite3
 import statistics
-from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
 
 import httpx
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from pydantic import BaseModel, HttpUrl
+from sortedcontainers import SortedList
 
 DB_PATH = os.getenv("WATCHDOG_DB", "watchdog.db")
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "60"))
 HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "64"))
+DB_SYNC = os.getenv("WATCHDOG_SYNC", "NORMAL").upper()
+STATUS_CACHE_TTL = min(CHECK_INTERVAL, 10)
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "8"))
+RETENTION_INTERVAL = 3600
 
-app = FastAPI(title="Uptime Watchdog", version="0.1.0")
+# uptime_7d is rebuilt from stored results on startup, so they must cover it.
+if RETENTION_DAYS < 7:
+    raise ValueError(f"RETENTION_DAYS must be at least 7, got {RETENTION_DAYS}")
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Uptime Watchdog", version="0.1.0", default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# One connection shared by the monitor loop and the API handlers. The lock
+# keeps statements from different threads from interleaving on it.
+_CONN: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.RLock()
 
 def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    global _CONN
+    with _DB_LOCK:
+        if _CONN is None:
+            if DB_SYNC not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+                raise ValueError(f"Invalid WATCHDOG_SYNC value: {DB_SYNC!r}")
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f"PRAGMA synchronous={DB_SYNC}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute("PRAGMA cache_size=-20000")
+            _CONN = conn
+        return _CONN
 
 def init_db() -> None:
-    conn = get_conn()
+    with _DB_LOCK:
+        conn = get_conn()
+        # WAL is persistent in the database file, so it only needs setting once.
+        conn.execute("PRAGMA journal_mode=WAL")
+        _create_schema(conn)
+
+# results.ts is microseconds since the Unix epoch (UTC).
+_RESULTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        check_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        ok INTEGER NOT NULL,
+        status_code INTEGER,
+        elapsed_ms REAL,
+        error TEXT,
+        FOREIGN KEY(check_id) REFERENCES checks(id)
+    )
+"""
+
+def _create_schema(conn: sqlite3.Connection) -> None:
     cur = conn.cursor()
     cur.execute("""
         CREATE TABLE IF NOT EXISTS checks (
@@ -41,20 +97,30 @@ def init_db() -> None:
             created_at TEXT NOT NULL
         )
     """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            check_id INTEGER NOT NULL,
-            ts TEXT NOT NULL,
-            ok INTEGER NOT NULL,
-            status_code INTEGER,
-            elapsed_ms REAL,
-            error TEXT,
-            FOREIGN KEY(check_id) REFERENCES checks(id)
-        )
-    """)
-    conn.commit()
-    conn.close()
+    cur.execute(_RESULTS_TABLE_SQL)
+    columns = cur.execute("PRAGMA table_info(results)").fetchall()
+    ts_type = next(row["type"] for row in columns if row["name"] == "ts")
+    if ts_type.upper() == "TEXT":
+        _migrate_results_ts(conn)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_results_check_ts ON results (check_id, ts)")
+
+def _migrate_results_ts(conn: sqlite3.Connection) -> None:
+    """Rebuild a results table from before ts was stored as epoch microseconds."""
+    conn.create_function("iso_to_us", 1, lambda ts: to_epoch_us(datetime.fromisoformat(ts)), deterministic=True)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("ALTER TABLE results RENAME TO results_old")
+        conn.execute(_RESULTS_TABLE_SQL)
+        conn.execute("""
+            INSERT INTO results (id, check_id, ts, ok, status_code, elapsed_ms, error)
+            SELECT id, check_id, iso_to_us(ts), ok, status_code, elapsed_ms, error FROM results_old
+        """)
+        conn.execute("DROP TABLE results_old")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    conn.create_function("iso_to_us", 1, None)
 
 class CheckIn(BaseModel):
     url: HttpUrl
@@ -76,58 +142,150 @@ class StatusItem(BaseModel):
 def now_utc_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+def to_epoch_us(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1_000_000)
+
+def now_epoch_us() -> int:
+    return time.time_ns() // 1_000
+
 def select_all_checks() -> List[sqlite3.Row]:
-    conn = get_conn()
-    rows = conn.execute("SELECT id, url, created_at FROM checks ORDER BY id ASC").fetchall()
-    conn.close()
-    return rows
+    with _DB_LOCK:
+        return get_conn().execute("SELECT id, url, created_at FROM checks ORDER BY id ASC").fetchall()
+
+def get_check_by_id(check_id: int) -> Optional[sqlite3.Row]:
+    with _DB_LOCK:
+        return get_conn().execute("SELECT id, url, created_at FROM checks WHERE id=?", (check_id,)).fetchone()
 
 def insert_check(url: str) -> int:
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute("INSERT INTO checks (url, created_at) VALUES (?, ?)", (url, now_utc_iso()))
-        conn.commit()
-        return cur.lastrowid
-    except sqlite3.IntegrityError:
-        existing = conn.execute("SELECT id FROM checks WHERE url=?", (url,)).fetchone()
-        if existing:
-            return int(existing["id"])
-        raise
-    finally:
-        conn.close()
-
-def insert_result(check_id: int, ok: bool, status_code: Optional[int], elapsed_ms: Optional[float], error: Optional[str]) -> None:
-    conn = get_conn()
-    conn.execute(
-        "INSERT INTO results (check_id, ts, ok, status_code, elapsed_ms, error) VALUES (?, ?, ?, ?, ?, ?)",
-        (check_id, now_utc_iso(), 1 if ok else 0, status_code, elapsed_ms, error),
-    )
-    conn.commit()
-    conn.close()
-
-def fetch_results_since(check_id: int, since: datetime) -> List[sqlite3.Row]:
-    conn = get_conn()
-    rows = conn.execute(
-        "SELECT ok, status_code, elapsed_ms, ts FROM results WHERE check_id=? AND ts>=? ORDER BY ts ASC",
-        (check_id, since.replace(tzinfo=timezone.utc).isoformat()),
-    ).fetchall()
-    conn.close()
-    return rows
-
-def percentile(values: List[float], p: float) -> Optional[float]:
-    if not values:
+    with _DB_LOCK:
+        conn = get_conn()
+        cur = conn.cursor()
+        try:
+            cur.execute("INSERT INTO checks (url, created_at) VALUES (?, ?)", (url, now_utc_iso()))
+            return cur.lastrowid
+        except sqlite3.IntegrityError:
+            existing = conn.execute("SELECT id FROM checks WHERE url=?", (url,)).fetchone()
+            if existing:
+                return int(existing["id"])
+            raise
+
+ResultRow = Tuple[int, int, int, Optional[int], Optional[float], Optional[str]]
+
+_SQL_INSERT_RESULT = "INSERT INTO results (check_id, ts, ok, status_code, elapsed_ms, error) VALUES (?, ?, ?, ?, ?, ?)"
+
+def insert_results(rows: List[ResultRow]) -> None:
+    if not rows:
+        return
+    with _DB_LOCK:
+        conn = get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(_SQL_INSERT_RESULT, rows)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def prune_results(before_us: int) -> int:
+    with _DB_LOCK:
+        conn = get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = conn.execute("DELETE FROM results WHERE ts<?", (before_us,)).rowcount
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+def fetch_results_since(since_us: int) -> List[Tuple[int, int, int, Optional[float]]]:
+    with _DB_LOCK:
+        cur = get_conn().execute(
+            "SELECT check_id, ts, ok, elapsed_ms FROM results WHERE ts>=? ORDER BY ts ASC",
+            (since_us,),
+        )
+        # Plain tuples rather than sqlite3.Row: the rows are unpacked positionally.
+        cur.row_factory = None
+        return cur.fetchall()
+
+def percentile(values_sorted: Sequence[float], p: float) -> Optional[float]:
+    if not values_sorted:
         return None
-    values_sorted = sorted(values)
     k = (len(values_sorted) - 1) * (p / 100.0)
     f = math.floor(k)
     c = math.ceil(k)
     if f == c:
-        return float(values_sorted[int(k)])
+        return float(values_sorted[f])
     d0 = values_sorted[f] * (c - k)
     d1 = values_sorted[c] * (k - f)
     return float(d0 + d1)
 
+DAY_US = 24 * 60 * 60 * 1_000_000
+WEEK_US = 7 * DAY_US
+
+class RollingStats:
+    """Running 24h/7d counters for one check, so /api/status never rescans history."""
+
+    def __init__(self) -> None:
+        self.samples_7d: Deque[Tuple[int, int]] = deque()
+        self.samples_24h: Deque[Tuple[int, int, Optional[float]]] = deque()
+        self.ok_7d = 0
+        self.ok_24h = 0
+        self.latencies_24h = SortedList()
+
+    def add(self, ts: int, ok: int, elapsed_ms: Optional[float]) -> None:
+        self.samples_7d.append((ts, ok))
+        self.ok_7d += ok
+        self.samples_24h.append((ts, ok, elapsed_ms))
+        self.ok_24h += ok
+        if ok and elapsed_ms is not None:
+            self.latencies_24h.add(elapsed_ms)
+        # Drop old samples as new ones arrive so memory stays bounded even
+        # when /api/status is never read.
+        self.expire(ts)
+
+    def expire(self, now_us: int) -> None:
+        cutoff_7d = now_us - WEEK_US
+        while self.samples_7d and self.samples_7d[0][0] < cutoff_7d:
+            _, ok = self.samples_7d.popleft()
+            self.ok_7d -= ok
+        cutoff_24h = now_us - DAY_US
+        while self.samples_24h and self.samples_24h[0][0] < cutoff_24h:
+            _, ok, elapsed_ms = self.samples_24h.popleft()
+            self.ok_24h -= ok
+            if ok and elapsed_ms is not None:
+                self.latencies_24h.remove(elapsed_ms)
+
+    def snapshot(self, now_us: int) -> Tuple[float, float, int, Optional[float]]:
+        """Return ``(uptime_24h, uptime_7d, samples_24h, p95_ms_24h)``."""
+        self.expire(now_us)
+        n24 = len(self.samples_24h)
+        n7 = len(self.samples_7d)
+        up24 = self.ok_24h / n24 * 100.0 if n24 else 0.0
+        up7 = self.ok_7d / n7 * 100.0 if n7 else 0.0
+        return up24, up7, n24, percentile(self.latencies_24h, 95.0)
+
+# Keyed by check id. Written by the monitor loop, read by status requests
+# running in worker threads.
+STATS: Dict[int, RollingStats] = {}
+_STATS_LOCK = threading.Lock()
+
+def record_results(rows: List[ResultRow]) -> None:
+    with _STATS_LOCK:
+        for check_id, ts, ok, _status_code, elapsed_ms, _error in rows:
+            STATS.setdefault(check_id, RollingStats()).add(ts, ok, elapsed_ms)
+
+def load_stats() -> None:
+    """Seed STATS from the last 7 days of stored results."""
+    rows = fetch_results_since(now_epoch_us() - WEEK_US)
+    with _STATS_LOCK:
+        STATS.clear()
+        for check_id, ts, ok, elapsed_ms in rows:
+            STATS.setdefault(check_id, RollingStats()).add(ts, ok, elapsed_ms)
+
 def score_and_grade(uptime_pct: float, p95_ms: Optional[float]) -> Tuple[float, str]:
     uptime_score = max(0.0, min(100.0, uptime_pct))
     if p95_ms is None:
@@ -164,70 +322,123 @@ def score_and_grade(uptime_pct: float, p95_ms: Optional[float]) -> Tuple[float,
         grade = "F"
     return float(score), grade
 
-async def check_once(client: httpx.AsyncClient, check_id: int, url: str) -> None:
+CHECK_SEM = asyncio.Semaphore(MAX_CONCURRENCY)
+
+async def check_once(client: httpx.AsyncClient, check_id: int, url: str, ts: int) -> ResultRow:
     try:
-        start = datetime.now(timezone.utc)
-        resp = await client.get(url, timeout=HTTP_TIMEOUT)
-        elapsed_ms = (datetime.now(timezone.utc) - start).total_seconds() * 1000.0
+        async with CHECK_SEM:
+            start = time.perf_counter()
+            resp = await client.get(url, timeout=HTTP_TIMEOUT)
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
         ok = 200 <= resp.status_code < 400
-        insert_result(check_id, ok=ok, status_code=resp.status_code, elapsed_ms=elapsed_ms, error=None)
+        return (check_id, ts, 1 if ok else 0, resp.status_code, elapsed_ms, None)
     except Exception as e:
-        insert_result(check_id, ok=False, status_code=None, elapsed_ms=None, error=str(e)[:300])
+        return (check_id, ts, 0, None, None, str(e)[:300])
 
 async def monitor_loop() -> None:
-    async with httpx.AsyncClient(follow_redirects=True, verify=False) as client:
+    limits = httpx.Limits(max_keepalive_connections=100, max_connections=200)
+    async with httpx.AsyncClient(follow_redirects=True, verify=False, http2=True, limits=limits) as client:
         while True:
-            checks = select_all_checks()
-            tasks = [check_once(client, row["id"], row["url"]) for row in checks]
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                checks = await asyncio.to_thread(select_all_checks)
+                # Every result from one tick shares the tick's start timestamp.
+                ts = now_epoch_us()
+                tasks = [check_once(client, row["id"], row["url"], ts) for row in checks]
+                if tasks:
+                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                    rows = [r for r in results if not isinstance(r, BaseException)]
+                    await asyncio.to_thread(insert_results, rows)
+                    record_results(rows)
+            except Exception:
+                logger.exception("Monitor tick failed; skipping it")
             await asyncio.sleep(CHECK_INTERVAL)
 
+async def retention_loop() -> None:
+    while True:
+        cutoff_us = now_epoch_us() - RETENTION_DAYS * DAY_US
+        try:
+            await asyncio.to_thread(prune_results, cutoff_us)
+        except Exception:
+            logger.exception("Pruning old results failed; retrying next run")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+def _compute_status() -> List[Dict[str, Any]]:
+    # Plain dicts in StatusItem's shape.
+    rows = select_all_checks()
+    out: List[Dict[str, Any]] = []
+    now_us = now_epoch_us()
+    with _STATS_LOCK:
+        snapshots = {check_id: stats.snapshot(now_us) for check_id, stats in STATS.items()}
+    for r in rows:
+        up24, up7, n24, p95_24 = snapshots.get(r["id"], (0.0, 0.0, 0, None))
+        score, grade = score_and_grade(up24, p95_24)
+        out.append(
+            {
+                "url": r["url"],
+                "uptime_24h": round(up24, 2),
+                "uptime_7d": round(up7, 2),
+                "p95_ms_24h": round(p95_24, 1) if p95_24 is not None else None,
+                "total_samples_24h": n24,
+                "grade": grade,
+                "score": round(score, 1),
+            }
+        )
+    return out
+
+# (expires_at, body, etag) for the last rendered /api/status payload.
+_status_cache: Optional[Tuple[float, bytes, str]] = None
+_status_lock = asyncio.Lock()
+# Bumped on every invalidation so a build that started before it is not cached.
+_status_generation = 0
+
+def invalidate_status_cache() -> None:
+    global _status_cache, _status_generation
+    _status_generation += 1
+    _status_cache = None
+
+async def get_status_payload() -> Tuple[bytes, str]:
+    global _status_cache
+    async with _status_lock:
+        now = time.monotonic()
+        if _status_cache is not None and _status_cache[0] > now:
+            return _status_cache[1], _status_cache[2]
+        generation = _status_generation
+        items = await asyncio.to_thread(_compute_status)
+        body = orjson.dumps(items)
+        # Weak, since GZipMiddleware may serve a compressed representation.
+        etag = 'W/"' + hashlib.sha1(body).hexdigest() + '"'
+        if generation == _status_generation:
+            _status_cache = (now + STATUS_CACHE_TTL, body, etag)
+        return body, etag
+
 @app.on_event("startup")
 async def on_startup() -> None:
-    init_db()
+    await asyncio.to_thread(init_db)
+    await asyncio.to_thread(load_stats)
     asyncio.create_task(monitor_loop())
+    asyncio.create_task(retention_loop())
 
-@app.get("/api/checks", response_model=List[CheckOut])
-def api_list_checks():
-    rows = select_all_checks()
-    return [CheckOut(id=row["id"], url=row["url"], created_at=row["created_at"]) for row in rows]
+# Listing endpoints return pre-shaped payloads directly; the models are only
+# advertised in the OpenAPI schema so responses skip Pydantic validation.
+@app.get("/api/checks", responses={200: {"model": List[CheckOut]}})
+async def api_list_checks():
+    rows = await asyncio.to_thread(select_all_checks)
+    return ORJSONResponse([dict(row) for row in rows])
 
 @app.post("/api/checks", response_model=CheckOut)
-def api_add_check(payload: CheckIn):
-    check_id = insert_check(str(payload.url))
-    rows = select_all_checks()
-    row = next((r for r in rows if r["id"] == check_id), None)
+async def api_add_check(payload: CheckIn):
+    check_id = await asyncio.to_thread(insert_check, str(payload.url))
+    invalidate_status_cache()
+    row = await asyncio.to_thread(get_check_by_id, check_id)
     assert row is not None
     return CheckOut(id=row["id"], url=row["url"], created_at=row["created_at"])
 
-@app.get("/api/status", response_model=List[StatusItem])
-def api_status():
-    rows = select_all_checks()
-    out: List[StatusItem] = []
-    now = datetime.now(timezone.utc)
-    since_24h = now - timedelta(hours=24)
-    since_7d = now - timedelta(days=7)
-    for r in rows:
-        r24 = fetch_results_since(r["id"], since_24h)
-        r7 = fetch_results_since(r["id"], since_7d)
-        up24 = (sum(rr["ok"] for rr in r24) / len(r24) * 100.0) if r24 else 0.0
-        up7 = (sum(rr["ok"] for rr in r7) / len(r7) * 100.0) if r7 else 0.0
-        latencies_24 = [rr["elapsed_ms"] for rr in r24 if rr["ok"] and rr["elapsed_ms"] is not None]
-        p95_24 = percentile(latencies_24, 95.0)
-        score, grade = score_and_grade(up24, p95_24)
-        out.append(
-            StatusItem(
-                url=r["url"],
-                uptime_24h=round(up24, 2),
-                uptime_7d=round(up7, 2),
-                p95_ms_24h=round(p95_24, 1) if p95_24 is not None else None,
-                total_samples_24h=len(r24),
-                grade=grade,
-                score=round(score, 1),
-            )
-        )
-    return out
+@app.get("/api/status", responses={200: {"model": List[StatusItem]}})
+async def api_status(request: Request):
+    body, etag = await get_status_payload()
+    if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 INDEX_HTML = """
 <!doctype html>
@@ -893,14 +1104,22 @@ INDEX_HTML = """
 </html>
 """
 
+INDEX_BYTES = INDEX_HTML.replace("%CHECK_INTERVAL%", str(CHECK_INTERVAL)).encode("utf-8")
+INDEX_GZIP = gzip.compress(INDEX_BYTES, 6)
+
 @app.get("/", response_class=HTMLResponse)
-def index():
-    html = INDEX_HTML.replace("%CHECK_INTERVAL%", str(CHECK_INTERVAL))
-    return HTMLResponse(content=html)
+def index(request: Request):
+    headers = {"Cache-Control": "public, max-age=60", "Vary": "Accept-Encoding"}
+    # Serve the pre-compressed page directly; GZipMiddleware leaves responses
+    # that already carry a Content-Encoding alone.
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(content=INDEX_GZIP, headers=headers)
+    return HTMLResponse(content=INDEX_BYTES, headers=headers)
 
 @app.get("/api/health")
 def health():
-    return JSONResponse({"status": "ok", "time": now_utc_iso(), "interval_s": CHECK_INTERVAL})
+    return ORJSONResponse({"status": "ok", "time": now_utc_iso(), "interval_s": CHECK_INTERVAL})
 
 if __name__ == "__main__":
     import uvicorn